@@ -1,10 +1,18 @@
+import glob
+import hashlib
+import html
+import json
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import streamlit as st
-from sklearn.neighbors import NearestNeighbors
-from openai import AzureOpenAI
+import tiktoken
+from openai import AzureOpenAI, BadRequestError, RateLimitError
 from datetime import datetime
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # -------------------- CONFIG --------------------
 AZURE_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
@@ -15,6 +23,53 @@ API_VERSION = os.environ["OPENAI_API_VERSION"]
 EMBEDDING_DEPLOYMENT = "text-embedding-3-small"
 CHAT_DEPLOYMENT = "RPA-Test-Nano"
 
+# Documents sent per embeddings request when building the index
+EMBEDDING_BATCH_SIZE = 128
+# Concurrent single-input requests when the deployment rejects list input
+EMBEDDING_MAX_WORKERS = 16
+
+# On-disk embedding cache, keyed by SHA-256 of the document text
+EMBEDDING_CACHE_FILE = f".emb_cache_{EMBEDDING_DEPLOYMENT}.npz"
+# Normalized float32 index matrix, keyed by a digest of the document hashes and
+# memory-mapped so worker processes share one file in the page cache
+INDEX_FILE_PREFIX = f".index_{EMBEDDING_DEPLOYMENT}_"
+
+# Semantic answer cache: random-hyperplane LSH over query embeddings
+EMBEDDING_DIM = 1536
+SEMANTIC_CACHE_BITS = 16
+SEMANTIC_CACHE_THRESHOLD = 0.95
+# Shared by all sessions, so bounded: least recently used buckets are evicted
+SEMANTIC_CACHE_MAX_BUCKETS = 1024
+SEMANTIC_CACHE_BUCKET_SIZE = 8
+# Exact answer cache, also shared by all sessions and LRU-bounded
+ANSWER_CACHE_MAX_ENTRIES = 4096
+
+# Prompt token budgets for retrieved rows (o200k_base, the GPT-4o/4.1 family)
+CHAT_ENCODING = "o200k_base"
+DOC_TOKEN_LIMIT = 400
+# Below top_k * DOC_TOKEN_LIMIT so long rows do hit the total cap
+CONTEXT_TOKEN_LIMIT = 1500
+# Rough size of a token, used to cap context when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+# Kept byte-for-byte identical across requests so the served prompt prefix
+# can be reused; per-query text goes after it.
+SYSTEM_PROMPT = (
+    "You are a helpful assistant. Always answer using only the data provided. "
+    "The data comes from an automation process inventory. Each data row is one "
+    "line formatted as 'Column: value | Column: value' with these columns, in order: "
+    "Process ID; Department; Sub Department; Process Name; Process Owner; "
+    "Point of Contact; Scheduled Run; Frequency; Retired; User Account; VM; SLA; "
+    "Prod CyberArK Name; App1 Type; App1 Details; App2 Details; Input Location; "
+    "Output Location; Sharepoint Path; Estimated Completion (min); Uses H Drive; "
+    "H Drive Interaction Type; Uses Sharepoint/Y Drive/I Drive; SP Save Type; "
+    "Alteryx Workflow Involved; Known Pain Points; Negative Business Impact; "
+    "Negative Department Impact; Business/Dept Impact Description. "
+    "Pay close attention to all columns (for example Process Name, Process Owner "
+    "and Point of Contact), and treat 'nan' as a missing value. If the data does "
+    "not contain the answer, say so."
+)
+
 # -------------------- CLIENT --------------------
 client = AzureOpenAI(
     api_key=AZURE_API_KEY,
@@ -23,45 +78,280 @@ client = AzureOpenAI(
 )
 
 # -------------------- HELPERS --------------------
-def get_embedding(text: str):
+embedding_retry = retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential(multiplier=1, min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+@embedding_retry
+def fetch_embedding(text: str):
     resp = client.embeddings.create(
         model=EMBEDDING_DEPLOYMENT,
         input=text
     )
-    return resp.data[0].embedding
+    return tuple(resp.data[0].embedding)
+
+@st.cache_resource(show_spinner=False)
+def get_query_embedding_stats():
+    return {"lookups": 0, "misses": 0}
+
+# Shared across reruns and sessions; the body only runs on a cache miss
+@st.cache_data(ttl=3600, max_entries=10000, show_spinner=False)
+def cached_embedding(text: str):
+    get_query_embedding_stats()["misses"] += 1
+    return fetch_embedding(text)
+
+def get_embedding(text: str):
+    get_query_embedding_stats()["lookups"] += 1
+    return cached_embedding(text)
+
+@embedding_retry
+def get_embeddings_batch(texts):
+    resp = client.embeddings.create(
+        model=EMBEDDING_DEPLOYMENT,
+        input=list(texts)
+    )
+    # The API tags each vector with its input position
+    return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+# Cleared once the deployment rejects list input, so later batches skip the
+# failing round-trip
+embedding_list_input = {"supported": True}
+
+def embed_documents(texts):
+    if embedding_list_input["supported"]:
+        try:
+            return get_embeddings_batch(texts)
+        except BadRequestError:
+            # Some Azure API versions only accept a single input per request.
+            # If a single input also fails, the 400 was about the input itself
+            # and is raised from here.
+            first = fetch_embedding(texts[0])
+            embedding_list_input["supported"] = False
+            return [first] + embed_documents(texts[1:])
+    with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as ex:
+        return list(ex.map(fetch_embedding, texts))
 
 def prepare_documents(df: pd.DataFrame):
-    docs = []
-    for _, row in df.iterrows():
-        parts = []
-        for col in df.columns:
-            parts.append(f"{col}: {row[col]}")
-        docs.append(" | ".join(parts))
-    return docs
+    cols = list(df.columns)
+    return [
+        " | ".join(f"{col}: {val}" for col, val in zip(cols, row))
+        for row in df.itertuples(index=False, name=None)
+    ]
+
+def load_embedding_cache():
+    if not os.path.exists(EMBEDDING_CACHE_FILE):
+        return {}
+    try:
+        with np.load(EMBEDDING_CACHE_FILE) as data:
+            return dict(zip(data["keys"].tolist(), data["vecs"]))
+    except Exception:
+        return {}
+
+def save_embedding_cache(cache, keys):
+    # Write to a temp file and swap it in so concurrent workers never read a
+    # partial archive; only rows still in the workbook are kept.
+    keys = list(dict.fromkeys(keys))
+    tmp_file = f"{EMBEDDING_CACHE_FILE}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_file, keys=np.array(keys), vecs=np.stack([cache[k] for k in keys]))
+    os.replace(tmp_file, EMBEDDING_CACHE_FILE)
+
+def load_index_file(index_file, num_rows):
+    try:
+        X = np.load(index_file, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if X.ndim != 2 or X.shape != (num_rows, EMBEDDING_DIM) or X.dtype != np.float32:
+        return None
+    return X
 
 def build_nn_index(documents):
-    embeddings = [get_embedding(doc) for doc in documents]
-    X = np.array(embeddings)
-    nn = NearestNeighbors(n_neighbors=5, metric="cosine")
-    nn.fit(X)
-    return nn, X, documents
+    keys = [hashlib.sha256(doc.encode("utf-8")).hexdigest() for doc in documents]
+    index_file = f"{INDEX_FILE_PREFIX}{hashlib.sha256(''.join(keys).encode('ascii')).hexdigest()[:16]}.npy"
+    if os.path.exists(index_file):
+        X = load_index_file(index_file, len(documents))
+        if X is not None:
+            return X, documents
 
-def query_rag(question, nn, X, documents, top_k=5):
-    q_emb = np.array(get_embedding(question)).reshape(1, -1)
-    distances, indices = nn.kneighbors(q_emb, n_neighbors=top_k)
-    
-    retrieved_docs = [documents[i] for i in indices[0]]
-    context = "\n".join(retrieved_docs)
-    
-    resp = client.chat.completions.create(
+    cache = load_embedding_cache()
+
+    missing = [(k, doc) for k, doc in dict(zip(keys, documents)).items() if k not in cache]
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        vecs = embed_documents([doc for _, doc in batch])
+        for (k, _), vec in zip(batch, vecs):
+            cache[k] = np.asarray(vec, dtype=np.float16)
+    if missing or len(cache) != len(set(keys)):
+        try:
+            save_embedding_cache(cache, keys)
+        except OSError:
+            pass
+
+    X = np.stack([cache[k] for k in keys]).astype(np.float32)
+    # Cosine similarity on unit vectors is a plain dot product
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    # float16 is only the on-disk cache format; NumPy has no BLAS path for
+    # float16 products, so the search matrix stays float32.
+    try:
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, X)
+        # Another worker may have published a valid index meanwhile; keep its
+        # inode so every process maps the same file. Anything else is replaced.
+        if load_index_file(index_file, len(documents)) is not None:
+            os.remove(tmp_file)
+        else:
+            os.replace(tmp_file, index_file)
+        for stale in glob.glob(f"{INDEX_FILE_PREFIX}*.npy"):
+            if stale != index_file:
+                os.remove(stale)
+        mapped = load_index_file(index_file, len(documents))
+        if mapped is not None:
+            X = mapped
+    except OSError:
+        pass
+    return X, documents
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache():
+    rng = np.random.default_rng(0)
+    planes = rng.standard_normal((SEMANTIC_CACHE_BITS, EMBEDDING_DIM)).astype(np.float32)
+    # signature -> list of (unit query embedding, answer), in LRU order
+    return planes, OrderedDict(), threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    # blake2b(question + retrieved row ids) -> answer, in LRU order
+    return OrderedDict(), threading.Lock()
+
+def answer_lookup(key):
+    answers, lock = get_answer_cache()
+    with lock:
+        answer = answers.get(key)
+        if answer is not None:
+            answers.move_to_end(key)
+        return answer
+
+def answer_store(key, answer):
+    answers, lock = get_answer_cache()
+    with lock:
+        answers[key] = answer
+        answers.move_to_end(key)
+        while len(answers) > ANSWER_CACHE_MAX_ENTRIES:
+            answers.popitem(last=False)
+
+def semantic_signature(q, planes):
+    bits = (planes @ q) > 0
+    return int(bits.astype(np.int64) @ (1 << np.arange(len(bits), dtype=np.int64)))
+
+def semantic_lookup(sig, q_unit):
+    _, semcache, lock = get_semantic_cache()
+    with lock:
+        bucket = semcache.get(sig)
+        if bucket is None:
+            return None
+        semcache.move_to_end(sig)
+        for cached_emb, cached_answer in bucket:
+            if float(cached_emb @ q_unit) > SEMANTIC_CACHE_THRESHOLD:
+                return cached_answer
+    return None
+
+def semantic_store(sig, q_unit, answer):
+    _, semcache, lock = get_semantic_cache()
+    with lock:
+        bucket = semcache.setdefault(sig, [])
+        semcache.move_to_end(sig)
+        bucket.append((q_unit, answer))
+        del bucket[:-SEMANTIC_CACHE_BUCKET_SIZE]
+        while len(semcache) > SEMANTIC_CACHE_MAX_BUCKETS:
+            semcache.popitem(last=False)
+
+def search_index(X, q_unit, top_k):
+    # X rows are unit-norm float32, so one BLAS matrix-vector product gives
+    # every cosine similarity; argpartition avoids a full sort for the top-k.
+    sims = X @ q_unit.astype(np.float32, copy=False)
+    top_k = min(top_k, len(sims))
+    idx = np.argpartition(-sims, top_k - 1)[:top_k]
+    return idx[np.argsort(-sims[idx])]
+
+@st.cache_resource(show_spinner=False)
+def get_chat_encoding():
+    # tiktoken downloads the BPE file on first use; without network access
+    # fall back to a character budget instead of failing every query
+    try:
+        return tiktoken.get_encoding(CHAT_ENCODING)
+    except Exception:
+        return None
+
+def trim_to_token_budget(docs, doc_limit=DOC_TOKEN_LIMIT, total_limit=CONTEXT_TOKEN_LIMIT):
+    # Budget is spent in input order; the result stays aligned with docs and
+    # rows past the budget come back empty
+    enc = get_chat_encoding()
+    trimmed = []
+    remaining = total_limit
+    for doc in docs:
+        limit = min(doc_limit, remaining)
+        if limit <= 0:
+            trimmed.append("")
+            continue
+        if enc is None:
+            piece = doc[:limit * CHARS_PER_TOKEN]
+            used = -(-len(piece) // CHARS_PER_TOKEN)
+        else:
+            ids = enc.encode(doc)[:limit]
+            piece = enc.decode(ids)
+            used = len(ids)
+        trimmed.append(piece)
+        remaining -= used
+    return trimmed
+
+def query_rag(question, X, documents, top_k=5):
+    q_emb = np.asarray(get_embedding(question), dtype=np.float32)
+
+    q_unit = q_emb / np.linalg.norm(q_emb)
+    indices = search_index(X, q_unit, top_k)
+    
+    # Exact (question, rows) match first; LSH is only the fuzzy fallback
+    answer_key = hashlib.blake2b(question.encode("utf-8") + indices.astype(np.int64).tobytes()).digest()
+    cached_answer = answer_lookup(answer_key)
+    if cached_answer is None:
+        sig = semantic_signature(q_unit, get_semantic_cache()[0])
+        cached_answer = semantic_lookup(sig, q_unit)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    
+    # Identical rows are sent once, keeping the best-ranked copy
+    row_ids = {}
+    for i in indices.tolist():
+        row_ids.setdefault(documents[i], i)
+    # Spend the token budget in similarity order so the closest rows survive,
+    # then send them in row order so overlapping top-k sets share a longer
+    # prompt prefix
+    trimmed = trim_to_token_budget(list(row_ids))
+    context = "\n".join(piece for _, piece in sorted(zip(row_ids.values(), trimmed)) if piece)
+    
+    stream = client.chat.completions.create(
         model=CHAT_DEPLOYMENT,
         messages=[
-            {"role": "system", "content": "You are a helpful assistant. Always answer using only the data provided. Pay close attention to all columns (ProcessName, Owner, Step, Tool, etc."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": f"Data:\n{context}\n\nQuestion: {question}"}
         ],
-        temperature=0
+        temperature=0,
+        stream=True
     )
-    return resp.choices[0].message.content
+    parts = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            yield parts[-1]
+    # Only a fully received, non-empty answer is cached
+    answer = "".join(parts)
+    if answer:
+        answer_store(answer_key, answer)
+        semantic_store(sig, q_unit, answer)
 
 # -------------------- Streamlit UI --------------------
 st.set_page_config(
@@ -458,6 +748,15 @@ with st.sidebar:
             value=datetime.now().strftime("%I:%M %p")
         )
     
+    cache_stats = get_query_embedding_stats()
+    cache_lookups = cache_stats["lookups"]
+    cache_hits = cache_lookups - cache_stats["misses"]
+    st.metric(
+        label="Query Cache Hit Rate",
+        value=f"{cache_hits / cache_lookups:.0%}" if cache_lookups else "—",
+        delta=f"{cache_hits}/{cache_lookups} hits" if cache_lookups else None
+    )
+    
     st.divider()
     
     # Session Stats
@@ -534,22 +833,52 @@ st.markdown("""
 
 # -------------------- Load Excel --------------------
 EXCEL_FILE = "Data/process info ai.xlsx"
+# Bump when the workbook reader or prepare_documents output changes
+DOCS_CACHE_VERSION = "calamine-1"
+
+def load_documents():
+    # Keyed by format version, mtime and size so an edited workbook or a
+    # changed reader is re-parsed
+    stat = os.stat(EXCEL_FILE)
+    cache_file = f".docs_{DOCS_CACHE_VERSION}_{stat.st_mtime_ns}_{stat.st_size}.json"
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                documents = json.load(f)
+            if isinstance(documents, list) and all(isinstance(d, str) for d in documents):
+                return documents
+        except (OSError, ValueError):
+            pass
+    df = pd.read_excel(EXCEL_FILE, engine="calamine")
+    documents = prepare_documents(df)
+    try:
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(documents, f)
+        os.replace(tmp_file, cache_file)
+        for stale in glob.glob(".docs_*.json"):
+            if stale != cache_file:
+                os.remove(stale)
+    except OSError:
+        pass
+    return documents
 
 @st.cache_resource(show_spinner=False)
 def load_and_index_data():
     try:
-        df = pd.read_excel(EXCEL_FILE)
-        documents = prepare_documents(df)
-        nn, X, docs = build_nn_index(documents)
-        return nn, X, docs, True, len(df)
+        documents = load_documents()
+        X, docs = build_nn_index(documents)
+        # Load the tokenizer up front rather than on the first query
+        get_chat_encoding()
+        return X, docs, True, len(docs)
     except Exception as e:
-        return None, None, None, False, 0
+        return None, None, False, 0
 print("Current directory:", os.getcwd())
 print("Files here:", os.listdir("."))
 print("Files in data/:", os.listdir("data") if os.path.exists("data") else "No data folder")
 # Load data
 with st.spinner("⚙️ Initializing AI models and indexing data..."):
-    nn, X, docs, data_loaded, num_records = load_and_index_data()
+    X, docs, data_loaded, num_records = load_and_index_data()
 
 if data_loaded:
     # Professional success notification
@@ -620,10 +949,12 @@ with st.form(key="chat_form", clear_on_submit=True):
 if submit and user_input:
     if data_loaded:
         st.session_state.history.append(("user", user_input))
+        st.markdown(f'<div class="user-message">{html.escape(user_input)}</div>', unsafe_allow_html=True)
         
+        # Show tokens as they arrive; the rerun then redraws the styled history
         with st.spinner("Processing your query..."):
             try:
-                response = query_rag(user_input, nn, X, docs)
+                response = st.write_stream(query_rag(user_input, X, docs))
                 st.session_state.history.append(("bot", response))
             except Exception as e:
                 st.session_state.history.append(("bot", f"I apologize, but I encountered an error: {str(e)}"))